@@ -2,10 +2,15 @@
 
 from astropy.io import fits
 from astropy.io import ascii
-from astropy import units as u
-from astropy.coordinates import *
 from os import sep as os_path_sep
+from math import radians, degrees, sin, cos, asin, sqrt, floor, isfinite
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from functools import lru_cache
+from time import monotonic
+import numpy as np
 import argparse
+import re
 import pymongo
 import logging
 
@@ -14,7 +19,7 @@ import logging
 
 LOCAL_MONGO_URI = 'mongodb://localhost:27017/'
 
-MONGO_MAX_INT = 2 ** (8 * 8)  # Max supported int size
+MONGO_MAX_INT = 2 ** 63 - 1  # Max supported int size (BSON int64)
 
 DATA_KEY = "data"
 
@@ -22,7 +27,32 @@ SOURCE_KEY = "source"
 
 COORDS_KEY = "coords"
 
+LOC_KEY = "loc"
+
+# Dotted paths of coordinate bounds, for in-place updates
+RA_MIN_KEY = "%s.ra.min" % COORDS_KEY
+RA_MAX_KEY = "%s.ra.max" % COORDS_KEY
+RA_MED_KEY = "%s.ra.med" % COORDS_KEY
+DEC_MIN_KEY = "%s.dec.min" % COORDS_KEY
+DEC_MAX_KEY = "%s.dec.max" % COORDS_KEY
+DEC_MED_KEY = "%s.dec.med" % COORDS_KEY
+
+READ_CHUNK_SIZE = 10000  # Number of source rows converted at a time
+
+PROGRESS_INTERVAL = 1.0  # Minimum time between progress messages (seconds)
+
+MIN_INDEX_CELL_SIZE = 1e-6  # Smallest spatial index cell (unit-sphere chord, ~0.2 arcseconds)
+
+MIN_GEO_RADIUS = 1e-9  # Smallest $centerSphere query radius (radians, ~0.2 milliarcseconds)
+
+MATCH_QUERY_GROUP_SIZE = 1000  # Number of $geoWithin clauses per match query (keeps queries under 16 MB)
+
+BACKFILL_BATCH_SIZE = 1000  # Number of existing records updated per write when adding GeoJSON points
+
+args = None  # Command-line arguments (see parse_args)
+
 total_record_count = 0
+total_record_count_lock = Lock()  # Records are merged both while buffering and while writing
 
 # Setup logging
 # =========================================================
@@ -49,16 +79,18 @@ log.addHandler(file_handler)
 
 def get_table_from_file(fname: str, format: str, delim=None) -> fits.BinTableHDU:
     """
-    Open a .fits or ascii source file
+    Open a .fits or ascii source file.
+    FITS files are memory-mapped, so their data stays backed by the file
+    (which is kept open while the returned HDU is referenced).
     :param fname: path to source file
     :param format: file format
     :param delim: delimiter for ascii file reading
     :return: An HDUList object
     """
     try:
-        log.info("Opening '%s'" % fname)
+        log.info("Opening '%s'", fname)
         if format == "fits":
-            return fits.open(fname, memmp=True)[1]
+            return fits.open(fname, memmap=True, lazy_load_hdus=True)[1]
         else:
             args = [fname]
             kwargs = {}
@@ -72,11 +104,21 @@ def get_table_from_file(fname: str, format: str, delim=None) -> fits.BinTableHDU
         log.error("File not found!")
         exit(1)
     except OSError:
-        log.error("Something went wrong reading '%s'..." % fname)
-        log.error("Are you sure this is a %s-format file?" % format)
+        log.error("Something went wrong reading '%s'...", fname)
+        log.error("Are you sure this is a %s-format file?", format)
         exit(1)
 
 
+@lru_cache(maxsize=None)
+def get_client(db_uri: str) -> pymongo.MongoClient:
+    """
+    Get a MongoDB client, sharing one client (and its connection pool) per URI
+    :param db_uri: URI of MongoDB to connect to
+    :return: MongoDB client object
+    """
+    return pymongo.MongoClient(db_uri)
+
+
 def get_collection(
         coll_name: str,
         db_name: str,
@@ -96,23 +138,66 @@ def get_collection(
     try:
         log.info('Requesting collection... ')
 
-        client = pymongo.MongoClient(db_uri)
+        client = get_client(db_uri)
 
         db = client[db_name]
         coll = db[coll_name]
         if drop:
             coll.drop()
 
+        # Records written before the 2dsphere index existed need GeoJSON points to be matched
+        loc_index = [(LOC_KEY, pymongo.GEOSPHERE)]
+        if not any(index["key"] == loc_index for index in coll.index_information().values()):
+            backfill_geo_points(coll)
+            coll.create_index(loc_index)
+
         log.info('Found!')
         return coll
     except pymongo.errors.ConfigurationError:
-        log.error("Could not connect to URI '%s'" % db_uri)
+        log.error("Could not connect to URI '%s'", db_uri)
         exit(1)
     except Exception as e:
         log.error(e)
         exit(1)
 
 
+def backfill_geo_points(collection: pymongo.collection) -> None:
+    """
+    Add centers and GeoJSON points to stored records that have none (e.g. records written
+    before they were kept with each record), so those records can be coordinate-matched against.
+    Centers are computed from the stored coordinate bounds.
+    Records without a valid center get a null point, which the 2dsphere index skips,
+    so they are not scanned again if the backfill is interrupted and re-run.
+    :param collection: Mongo collection to update
+    """
+    operations = []
+    unmatchable_count = 0
+    for existing_record in collection.find({LOC_KEY: {"$exists": False}}, projection=[COORDS_KEY]):
+        try:
+            coords = existing_record[COORDS_KEY]
+            for axis in ("ra", "dec"):
+                if "med" not in coords[axis]:
+                    coords[axis]["med"] = (coords[axis]["min"] + coords[axis]["max"]) / 2
+            update = {RA_MED_KEY: coords["ra"]["med"], DEC_MED_KEY: coords["dec"]["med"],
+                      LOC_KEY: geo_point(existing_record)}
+        except (KeyError, TypeError):
+            update = {LOC_KEY: None}
+
+        if update[LOC_KEY] is None:
+            unmatchable_count += 1
+        operations.append(pymongo.UpdateOne({"_id": existing_record["_id"]}, {"$set": update}))
+
+        if len(operations) >= BACKFILL_BATCH_SIZE:
+            write_records(collection, operations)
+            operations = []
+
+    if operations:
+        write_records(collection, operations)
+    if unmatchable_count:
+        log.warning("%d existing records have no valid coordinates, and will not be matched against",
+                    unmatchable_count)
+
+
 def hdu_records(hdu_list: fits.BinTableHDU) -> fits.FITS_rec:
     """
     Generator function to yield each record in hdu_list
@@ -122,37 +207,75 @@ def hdu_records(hdu_list: fits.BinTableHDU) -> fits.FITS_rec:
     return hdu_list.data
 
 
-def generate_record(rec: fits.FITS_record, cols: fits.ColDefs) -> dict:
+def column_values(column: np.ndarray) -> list:
+    """
+    Converts a whole FITS column to a list of Python values in one step
+    :param column: Column array read from the FITS records
+    :return: List of Python values (one per record)
+    """
+    if column.dtype.kind in "SU":
+        # Match the trailing-whitespace stripping done when indexing single records
+        column = np.char.rstrip(column)
+    values = column.tolist()
+    if column.dtype.kind == "u" and column.dtype.itemsize >= 8 and column.size \
+            and int(column.max()) > MONGO_MAX_INT:
+        # Unsigned 64-bit values too large for BSON are stored as strings
+        #   (compared as Python ints, since uint64 vs int comparisons round through float64)
+        values = mongo_safe_ints(values)
+    return values
+
+
+def mongo_safe_ints(values):
+    """
+    Replace ints too large to store in a Mongo DB with their string form
+    :param values: Value, or (possibly nested) list of values
+    :return: Values with large ints replaced
+    """
+    if isinstance(values, list):
+        return [mongo_safe_ints(value) for value in values]
+    if isinstance(values, int) and values > MONGO_MAX_INT:
+        return str(values)
+    return values
+
+
+def generate_records(hdu_data: fits.FITS_rec, cols: fits.ColDefs):
     """
-    Returns a single dict object based on FITS records and columns.
-    :param rec: FITS record to convert
+    Generator function to yield a dict object for each FITS record.
+    Records are read in slices of READ_CHUNK_SIZE rows, and each slice's columns are
+    read once each as arrays, rather than cell-by-cell.
+    :param hdu_data: FITS records to convert
     :param cols: List of column definitions
-    :return: Dict object representing new record
-             format: {<col1>: {'format':<format>, 'value':<value>}, <col2>: {...}, ...}
+    :return: Generator of dict objects representing new records
+             format: {DATA_KEY: [{<col1>: <value>, <col2>: ...}], COORDS_KEY: {...}}
     """
     global args
 
-    record_data = {SOURCE_KEY: args.src}
-    coords = {"ra": {"min": None, "max": None}, "dec": {"min": None, "max": None}}
-    for c in cols:
-        # record[c.name] = {"value": rec[c.name], "unit": c.unit}
-        try:
-            record_data[c.name] = rec[c.name].item()
-        except AttributeError:
-            record_data[c.name] = rec[c.name]
+    names = cols.names
+    for coord_name in args.coords:
+        if coord_name not in names:
+            log.error("Coordinate column '%s' not found!", coord_name)
+            exit(1)
+
+    ra_index = names.index(args.coords[0])
+    dec_index = names.index(args.coords[1])
+
+    src = args.src
+    for start in range(0, len(hdu_data), READ_CHUNK_SIZE):
+        # Only this slice of a memory-mapped file is paged in and converted
+        rows = hdu_data[start:start + READ_CHUNK_SIZE]
+        col_lists = [column_values(rows[name]) for name in names]
+
+        for row in zip(*col_lists):
+            record_data = {SOURCE_KEY: src}
+            record_data.update(zip(names, row))
 
-        if c.name == args.coords[0]:
-            if coords["ra"]["min"] is None or rec[c.name] < coords["ra"]["min"]:
-                coords["ra"]["min"] = rec[c.name]
-            if coords["ra"]["max"] is None or rec[c.name] > coords["ra"]["max"]:
-                coords["ra"]["max"] = rec[c.name]
-        elif c.name == args.coords[1]:
-            if coords["dec"]["min"] is None or rec[c.name] < coords["dec"]["min"]:
-                coords["dec"]["min"] = rec[c.name]
-            if coords["dec"]["max"] is None or rec[c.name] > coords["dec"]["max"]:
-                coords["dec"]["max"] = rec[c.name]
+            ra, dec = row[ra_index], row[dec_index]
+            coords = {"ra": {"min": ra, "max": ra, "med": ra},
+                      "dec": {"min": dec, "max": dec, "med": dec}}
 
-    return {DATA_KEY: [record_data], COORDS_KEY: coords}
+            record = {DATA_KEY: [record_data], COORDS_KEY: coords}
+            set_geo_point(record)
+            yield record
 
 
 def get_fits_columns(hdu_list: fits.BinTableHDU) -> fits.ColDefs:
@@ -165,20 +288,30 @@ def get_fits_columns(hdu_list: fits.BinTableHDU) -> fits.ColDefs:
     return hdu_list.columns
 
 
-def insert_records(collection: pymongo.collection, record_list: list) -> int:
+def write_records(collection: pymongo.collection, operations: list) -> (int, set):
     """
-    Inserts many records into a Mongo DB.
-    :param collection: Mongo collection to insert into
-    :param record_list: List of records (dicts) to insert
-    :return: Number of records successfully written
+    Writes many records into a Mongo DB in a single unordered bulk write.
+    Operations may run in any order, and a failed operation does not stop the rest,
+    so operations that depend on each other must be written in separate calls.
+    :param collection: Mongo collection to write to
+    :param operations: List of pymongo write operations (InsertOne, UpdateOne, DeleteOne)
+    :return: Number of records successfully inserted or updated,
+             and the set of indexes (into operations) of failed operations
     """
-    log.info('Inserting %d records... ' % len(record_list))
+    log.debug('Writing %d operations... ', len(operations))
     try:
-        insert_result = collection.insert_many(record_list)
-        return len(insert_result.inserted_ids)
+        write_result = collection.bulk_write(operations, ordered=False)
+        return write_result.inserted_count + write_result.matched_count, set()
+    except pymongo.errors.BulkWriteError as bwe:
+        write_errors = bwe.details["writeErrors"]
+        log.error("Writing of %d/%d operations failed...", len(write_errors), len(operations))
+        for write_error in write_errors:
+            log.error("%s", write_error["errmsg"])
+        failed_indexes = {write_error["index"] for write_error in write_errors}
+        return bwe.details["nInserted"] + bwe.details["nMatched"], failed_indexes
     except pymongo.errors.OperationFailure as of:
-        log.error("Insertion of %d records failed..." % len(record_list))
-        log.error("%s" % str(of))
+        log.error("Writing of %d operations failed...", len(operations))
+        log.error("%s", of)
         exit(1)
 
 
@@ -187,103 +320,310 @@ def upload_hdu_list(hdu_bin_table: fits.BinTableHDU,
     """
     Reads hdu_list, extracts data into dict "records", and
     uploads chunks of data to a mongo collection.
+    Each chunk is written in a background thread while the next chunk is generated.
+    Chunks are written one at a time and in order, so each chunk is
+    coordinate-matched against all previously written chunks.
     :param hdu_bin_table: BinTableHDU object from which to read
     :param collection: Mongo collection to insert into
     :return: Number of records successfully written
     """
     global args, total_record_count
 
-    record_buffer = []  # List of records (as dicts)
+    record_buffer = {}  # Records (as dicts), keyed by id() for O(1) removal
+    buffer_index = {}  # Spatial index of record_buffer
     inserted_record_count = 0  # Total number of records inserted thus far
+    pending_write = None  # Write of the previous chunk, if still in progress
+    last_progress_time = monotonic()
 
     columns = get_fits_columns(hdu_bin_table)
 
     log.info('Generating records... ')
     hdu_record_list = hdu_records(hdu_bin_table)
-    total_record_count = len(hdu_record_list)
-    for r in hdu_record_list:
-        record = generate_record(r, columns)
-
-        # Coordinate-matches within the buffer
-        append_record(record, record_buffer)
-
-        # Write chunk of records to database
-        if 0 < args.buffer <= len(record_buffer):
-            # Coordinate-matches against database
-            tmp_count = insert_record_list(record_buffer, collection, args.sep)
-            inserted_record_count += tmp_count
-            log.info("\tProgress {}/{} ({:.2f}%)".format(
-                inserted_record_count, total_record_count,
-                (inserted_record_count * 100) / total_record_count
-            ))
-            record_buffer = []
+    total_record_count = hdu_bin_table.header["NAXIS2"]  # Row count, without touching the data
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for record in generate_records(hdu_record_list, columns):
+            # Coordinate-matches within the buffer
+            append_record(record, record_buffer, buffer_index)
+
+            # Write chunk of records to database
+            if 0 < args.buffer <= len(record_buffer):
+                # Wait for the previous chunk, so at most one chunk is held for writing
+                if pending_write is not None:
+                    inserted_record_count += pending_write.result()
+                    if monotonic() - last_progress_time >= PROGRESS_INTERVAL:
+                        log.info("\tProgress %d/%d (%.2f%%)",
+                                 inserted_record_count, total_record_count,
+                                 (inserted_record_count * 100) / total_record_count)
+                        last_progress_time = monotonic()
+
+                # Coordinate-matches against database
+                pending_write = writer.submit(insert_record_list, list(record_buffer.values()),
+                                              collection, args.sep)
+                record_buffer = {}
+                buffer_index = {}
+
+        if pending_write is not None:
+            inserted_record_count += pending_write.result()
 
     # Upload remaining records
-    inserted_record_count += insert_record_list(record_buffer, collection, args.sep)
-    log.info("All %d/%d records uploaded!" % (inserted_record_count, total_record_count))
+    inserted_record_count += insert_record_list(list(record_buffer.values()), collection, args.sep)
+    log.info("All %d/%d records uploaded!", inserted_record_count, total_record_count)
 
     return inserted_record_count
 
 
-def append_record(record: dict, list_of_records: list) -> None:
+def append_record(record: dict, dict_of_records: dict, index: dict) -> None:
     """
-    Append a record to a list of records, merging new record with existing records in the list
-    using astropy coordinate matching
+    Add a record to a buffer of records, merging new record with existing records in the buffer
+    using coordinate matching.
+    Only records in neighbouring cells of the spatial index are compared against.
+    Records without a finite center (e.g. NaN coordinates) are never matched or indexed.
     :param record: Record to insert
-    :param list_of_records: List to insert record into
+    :param dict_of_records: Buffer to insert record into, keyed by id() of each record
+    :param index: Spatial index of dict_of_records (see index_cell)
     """
     global args
 
+    if not has_finite_center(record):
+        dict_of_records[id(record)] = record
+        return
+
+    cell_size = index_cell_size(args.sep)
+
     # If record should be merged, then merge record with matching record
-    for existing_record in list_of_records:
-        if should_merge_by_distance(record, existing_record, args.sep):
-            record = merge_records(record, existing_record)
-            list_of_records.remove(existing_record)
-            break
+    match = next(indexed_matches(record, index, cell_size, args.sep), None)
+    if match is not None:
+        match_cell, existing_record = match
+        record = merge_records(record, existing_record)
+        del dict_of_records[id(existing_record)]
+        index_remove(index, match_cell, existing_record)
 
     # Insert the new (possibly merged) record
-    list_of_records.append(record)
+    dict_of_records[id(record)] = record
+    index_add(index, record, cell_size)
+
+
+def indexed_matches(record: dict, index: dict, cell_size: float, threshold: float):
+    """
+    Generator function to yield records in a spatial index that should be merged with the given record
+    :param record: Record to match
+    :param index: Spatial index to search
+    :param cell_size: Size of the index's cells (see index_cell_size)
+    :param threshold: Separation threshold (units: arcseconds)
+    :return: Generator of (cell, record) tuples for each matching record
+    """
+    x, y, z = index_cell(record, cell_size)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                cell = (x + dx, y + dy, z + dz)
+                for existing_record in index.get(cell, ()):
+                    if should_merge_by_distance(record, existing_record, threshold):
+                        yield cell, existing_record
+
+
+def index_add(index: dict, record: dict, cell_size: float) -> None:
+    """
+    Add a record to a spatial index
+    :param index: Spatial index to add to
+    :param record: Record to add
+    :param cell_size: Size of the index's cells (see index_cell_size)
+    """
+    index.setdefault(index_cell(record, cell_size), []).append(record)
+
+
+def index_remove(index: dict, cell: tuple, record: dict) -> None:
+    """
+    Remove a record from a spatial index
+    :param index: Spatial index to remove from
+    :param cell: Cell containing the record
+    :param record: Record to remove
+    """
+    index[cell].remove(record)
+    if not index[cell]:
+        del index[cell]
+
+
+def index_cell_size(threshold: float) -> float:
+    """
+    Size of spatial index cells such that records within threshold of each other
+    always fall in neighbouring cells
+    :param threshold: Separation threshold (units: arcseconds)
+    :return: Cell size (units: chord length on the unit sphere)
+    """
+    chord = 2 * sin(radians(threshold / 3600) / 2)
+    return max(chord, MIN_INDEX_CELL_SIZE)
+
+
+def index_cell(record: dict, cell_size: float) -> (int, int, int):
+    """
+    Get the spatial index cell of a record's center.
+    Cells are cubes over the cartesian unit vector of the center, which avoids
+    special cases for RA wrap-around and the poles.
+    :param record: Record to locate
+    :param cell_size: Size of the index's cells (see index_cell_size)
+    :return: Cell coordinates
+    """
+    ra, dec = record_center(record)
+    ra, dec = radians(ra), radians(dec)
+    return (floor(cos(dec) * cos(ra) / cell_size),
+            floor(cos(dec) * sin(ra) / cell_size),
+            floor(sin(dec) / cell_size))
+
+
+def geo_point(record: dict) -> dict:
+    """
+    Get a GeoJSON point at the center of a record's objects, for use with a 2dsphere index.
+    RA is wrapped into the [-180, 180) longitude range GeoJSON requires,
+    which leaves angular distances unchanged.
+    :param record: Record to locate
+    :return: GeoJSON point object, or None if the center is not a valid position
+    """
+    if not has_finite_center(record):
+        return None
+    ra, dec = record_center(record)
+    if not -90 <= dec <= 90:
+        return None
+    lon = (ra + 180) % 360 - 180
+    return {"type": "Point", "coordinates": [lon, dec]}
+
+
+def set_geo_point(record: dict) -> None:
+    """
+    Set (or remove) a record's GeoJSON point to match its center.
+    Records without a valid center are left without a point, which the 2dsphere index skips.
+    :param record: Record to update
+    """
+    loc = geo_point(record)
+    if loc is None:
+        record.pop(LOC_KEY, None)
+    else:
+        record[LOC_KEY] = loc
+
+
+def has_finite_center(record: dict) -> bool:
+    """
+    Check whether a record's center can be coordinate-matched
+    :param record: Record to check
+    :return: True if both RA and DEC of the center are finite numbers, False otherwise
+    """
+    ra, dec = record_center(record)
+    return isfinite(ra) and isfinite(dec)
+
+
+def record_center(record: dict) -> (float, float):
+    """
+    Get the center of a record's objects (stored with its coordinate bounds)
+    :param record: Record to locate
+    :return: (RA, DEC) of the center (units: degrees)
+    """
+    return record[COORDS_KEY]["ra"]["med"], record[COORDS_KEY]["dec"]["med"]
 
 
 def insert_record_list(list_of_records: list, collection: pymongo.collection,
                        threshold: float) -> int:
     """
     Insert all records in a list into a pymongo collection, merging records with records in the
-    collection using astropy coordinate matching
+    collection using coordinate matching.
+    Merges update the stored record in place, so its existing data is never re-sent.
     :param list_of_records:
     :param collection:
     :param threshold:
-    :return: count of records inserted
+    :return: count of records inserted or updated
     """
-    final_record_list = []
+    if not list_of_records:
+        return 0
+
+    radius = max(radians(threshold / 3600), MIN_GEO_RADIUS)
+    cell_size = index_cell_size(threshold)
+
+    # Records without a valid position cannot be matched, and are inserted as they are
+    matchable_records = [new_record for new_record in list_of_records if LOC_KEY in new_record]
+
+    # Generate mongo queries to find objects whose centers are within the
+    #    threshold of any new record (spherical caps, answered by the 2dsphere index),
+    #    grouping records so each query stays well under the maximum document size
+    candidate_index = {}
+    candidate_ids = set()  # A record near records of several groups is returned once per group
+    for start in range(0, len(matchable_records), MATCH_QUERY_GROUP_SIZE):
+        query = {"$or": [
+            {LOC_KEY: {"$geoWithin": {"$centerSphere": [new_record[LOC_KEY]["coordinates"], radius]}}}
+            for new_record in matchable_records[start:start + MATCH_QUERY_GROUP_SIZE]
+        ]}
+        for existing_record in collection.find(query, projection={DATA_KEY: False}):
+            if existing_record["_id"] not in candidate_ids:
+                candidate_ids.add(existing_record["_id"])
+                index_add(candidate_index, existing_record, cell_size)
+
+    matched_records = []  # (new record, list of matching existing records)
+    other_ids = []  # Existing records to be merged into another existing record
     for new_record in list_of_records:
-        # Generate mongo query to find objects whose coordinates are within the
-        #    bounds of the threshold (a square area)
-        #    (limits the number of comparisons while using actual coordinate matching)
-        ra_min = new_record[COORDS_KEY]["ra"]["min"] - threshold
-        ra_max = new_record[COORDS_KEY]["ra"]["max"] + threshold
-        dec_min = new_record[COORDS_KEY]["dec"]["min"] - threshold
-        dec_max = new_record[COORDS_KEY]["dec"]["max"] + threshold
-
-        query = {
-            "%s.%s.%s" % (COORDS_KEY, "ra", "min"): {"$lte": ra_max},
-            "%s.%s.%s" % (COORDS_KEY, "ra", "max"): {"$gte": ra_min},
-            "%s.%s.%s" % (COORDS_KEY, "dec", "min"): {"$lte": dec_max},
-            "%s.%s.%s" % (COORDS_KEY, "dec", "max"): {"$gte": dec_min}
+        if LOC_KEY not in new_record:
+            matched_records.append((new_record, []))
+            continue
+
+        # Compare against existing records near this record
+        #   (the query radius is padded, so a threshold of 0 still finds identical coordinates)
+        matches = list(indexed_matches(new_record, candidate_index, cell_size, threshold))
+        for match_cell, existing_record in matches:
+            index_remove(candidate_index, match_cell, existing_record)
+
+        existing_records = [existing_record for _, existing_record in matches]
+        matched_records.append((new_record, existing_records))
+        other_ids.extend(existing_record["_id"] for existing_record in existing_records[1:])
+
+    # Only records merging several existing records need any existing data
+    other_data = {}
+    if other_ids:
+        for existing_record in collection.find({"_id": {"$in": other_ids}}, projection=[DATA_KEY]):
+            other_data[existing_record["_id"]] = existing_record[DATA_KEY]
+
+    operations = []
+    fold_deletes = []  # (index of target's update in operations, ids of records folded into it)
+    for new_record, existing_records in matched_records:
+        if not existing_records:
+            operations.append(pymongo.InsertOne(new_record))
+            continue
+
+        # Update the first match in place, and fold any others into it
+        target_record, *other_records = existing_records
+        data = new_record[DATA_KEY]
+        merged_record = {COORDS_KEY: new_record[COORDS_KEY]}
+        for existing_record in existing_records:
+            merged_record[COORDS_KEY] = merge_coords(merged_record[COORDS_KEY],
+                                                     existing_record[COORDS_KEY])
+        for existing_record in other_records:
+            data = data + other_data[existing_record["_id"]]
+        if other_records:
+            folded_ids = [existing_record["_id"] for existing_record in other_records]
+            fold_deletes.append((len(operations), folded_ids))
+        coords = merged_record[COORDS_KEY]
+        count_merges(len(existing_records))
+
+        # Only the new data and the merged bounds and center are sent, never the stored data
+        update = {
+            "$push": {DATA_KEY: {"$each": data}},
+            "$min": {RA_MIN_KEY: coords["ra"]["min"], DEC_MIN_KEY: coords["dec"]["min"]},
+            "$max": {RA_MAX_KEY: coords["ra"]["max"], DEC_MAX_KEY: coords["dec"]["max"]},
+            "$set": {RA_MED_KEY: coords["ra"]["med"], DEC_MED_KEY: coords["dec"]["med"]}
         }
+        loc = geo_point(merged_record)
+        if loc is None:
+            update["$unset"] = {LOC_KEY: ""}
+        else:
+            update["$set"][LOC_KEY] = loc
+        operations.append(pymongo.UpdateOne({"_id": target_record["_id"]}, update))
 
-        # Compare against existing records matching the query
-        #   (since threshold is radius, not the length of a square)
-        for existing_record in collection.find(query):
-            if should_merge_by_distance(new_record, existing_record, threshold):
-                new_record = merge_records(new_record, existing_record)
-
-                collection.delete_one(existing_record)
+    written_count, failed_indexes = write_records(collection, operations)
 
-        final_record_list.append(new_record)
+    # Folded records are only deleted once their data is stored in the target record
+    delete_operations = [pymongo.DeleteOne({"_id": other_id})
+                         for update_index, folded_ids in fold_deletes if update_index not in failed_indexes
+                         for other_id in folded_ids]
+    if delete_operations:
+        write_records(collection, delete_operations)
 
-    inserted_count = insert_records(collection, final_record_list)
-    return inserted_count
+    return written_count
 
 
 def should_merge_by_distance(rec1: dict, rec2: dict, threshold: float) -> bool:
@@ -295,21 +635,30 @@ def should_merge_by_distance(rec1: dict, rec2: dict, threshold: float) -> bool:
                       less than the threshold
     :return: True if records are close enough to be merged, False otherwise
     """
-    med_ra1 = (rec1[COORDS_KEY]["ra"]["min"] + rec1[COORDS_KEY]["ra"]["max"]) / 2
-    med_ra2 = (rec2[COORDS_KEY]["ra"]["min"] + rec2[COORDS_KEY]["ra"]["max"]) / 2
-    med_dec1 = (rec1[COORDS_KEY]["dec"]["min"] + rec1[COORDS_KEY]["dec"]["max"]) / 2
-    med_dec2 = (rec2[COORDS_KEY]["dec"]["min"] + rec2[COORDS_KEY]["dec"]["max"]) / 2
+    med_ra1, med_dec1 = record_center(rec1)
+    med_ra2, med_dec2 = record_center(rec2)
 
-    coords1 = SkyCoord(ra=med_ra1 * u.degree, dec=med_dec1 * u.degree, distance=1, frame="icrs")
-    coords2 = SkyCoord(ra=med_ra2 * u.degree, dec=med_dec2 * u.degree, distance=1, frame="icrs")
+    sep = separation_arcsec(med_ra1, med_dec1, med_ra2, med_dec2)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("\tSeparation = %.2f (<%.2f, %.2f>, <%.2f, %.2f>)",
+                  sep,
+                  med_ra1 * 3600, med_dec1 * 3600,
+                  med_ra2 * 3600, med_dec2 * 3600)
+    return sep <= threshold
 
-    sep = coords1.separation(coords2)
-    log.debug("\tSeparation = {:.2f} (<{:.2f}, {:.2f}>, <{:.2f}, {:.2f}>)".format(
-        sep.to(u.arcsec),
-        coords1.ra.to(u.arcsec), coords1.ra.to(u.arcsec),
-        coords2.dec.to(u.arcsec), coords2.dec.to(u.arcsec))
-    )
-    return sep.is_within_bounds(-threshold * u.arcsec, threshold * u.arcsec)
+
+def separation_arcsec(ra1: float, dec1: float, ra2: float, dec2: float) -> float:
+    """
+    Angular separation between two points, using the haversine formula
+    :param ra1: RA of first point (units: degrees)
+    :param dec1: DEC of first point (units: degrees)
+    :param ra2: RA of second point (units: degrees)
+    :param dec2: DEC of second point (units: degrees)
+    :return: Separation (units: arcseconds)
+    """
+    ra1, dec1, ra2, dec2 = radians(ra1), radians(dec1), radians(ra2), radians(dec2)
+    a = sin((dec2 - dec1) / 2) ** 2 + cos(dec1) * cos(dec2) * sin((ra2 - ra1) / 2) ** 2
+    return degrees(2 * asin(min(1.0, sqrt(a)))) * 3600
 
 
 def merge_records(rec1: dict, rec2: dict) -> dict:
@@ -319,29 +668,45 @@ def merge_records(rec1: dict, rec2: dict) -> dict:
     :param rec2: second record
     :return: merged record
     """
-    global total_record_count
-
-    log.info("Merging records")
+    log.debug("Merging records")
 
     new_rec = {
         DATA_KEY: rec1[DATA_KEY] + rec2[DATA_KEY],
-        COORDS_KEY: {
-            "ra": {
-                "min": min(rec1[COORDS_KEY]["ra"]["min"], rec2[COORDS_KEY]["ra"]["min"]),
-                "max": min(rec1[COORDS_KEY]["ra"]["max"], rec2[COORDS_KEY]["ra"]["max"]),
-            },
-            "dec": {
-                "min": min(rec1[COORDS_KEY]["dec"]["min"], rec2[COORDS_KEY]["dec"]["min"]),
-                "max": min(rec1[COORDS_KEY]["dec"]["max"], rec2[COORDS_KEY]["dec"]["max"]),
-            }
-        }
+        COORDS_KEY: merge_coords(rec1[COORDS_KEY], rec2[COORDS_KEY])
     }
+    set_geo_point(new_rec)
 
-    total_record_count -= 1
+    count_merges(1)
 
     return new_rec
 
 
+def merge_coords(coords1: dict, coords2: dict) -> dict:
+    """
+    Merge two records' coordinate bounds
+    :param coords1: first record's coordinates
+    :param coords2: second record's coordinates
+    :return: coordinates bounding both records, with updated centers
+    """
+    merged_coords = {}
+    for axis in ("ra", "dec"):
+        low = min(coords1[axis]["min"], coords2[axis]["min"])
+        high = max(coords1[axis]["max"], coords2[axis]["max"])
+        merged_coords[axis] = {"min": low, "max": high, "med": (low + high) / 2}
+    return merged_coords
+
+
+def count_merges(count: int) -> None:
+    """
+    Remove merged records from the total record count
+    :param count: number of records merged into other records
+    """
+    global total_record_count
+
+    with total_record_count_lock:
+        total_record_count -= count
+
+
 # Main processing
 # =========================================================
 
@@ -358,7 +723,7 @@ def main():
 
     log.info('Done!')
 
-    log.info('Database successfully populated with {} records'.format(record_count))
+    log.info('Database successfully populated with %d records', record_count)
 
 
 # Argument parsing
@@ -368,11 +733,13 @@ def allow_escape_chars(s: str) -> str:
     return s.encode("utf-8").decode("unicode_escape")
 
 
+coords_sep_re = re.compile(r"\s*(,\s*)|\s+")
+
+
 def coords_type(s: str) -> (str, str):
-    import re
-    coords = re.split(r"\s*(,\s*)|\s+", s)
+    coords = coords_sep_re.split(s)
     if len(coords) != 3:
-        raise argparse.ArgumentError('Coords must be formatted as "<RA>, <DEC>"')
+        raise argparse.ArgumentTypeError('Coords must be formatted as "<RA>, <DEC>"')
     return coords[0], coords[2]
 
 
@@ -403,13 +770,17 @@ parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFo
                                  epilog="Valid options for FMT: "+(", ".join(formats)))
 
 parser.add_argument('source_path')
-parser.add_argument('-u', '--uri', help='MongoDB URI',
-                    default=LOCAL_MONGO_URI)
+parser.add_argument('-u', '--uri', default=LOCAL_MONGO_URI,
+                    help='MongoDB URI. Connection options may be given in the URI, '
+                         'e.g. append "?compressors=zlib" to compress traffic to a remote server.')
 parser.add_argument('-d', '--db', help='MongoDB database name')
 parser.add_argument('-c', '--coll', help='MongoDB collection name')
-parser.add_argument('-b', '--buffer', metavar="BUF", type=int, default=1,
+parser.add_argument('-b', '--buffer', metavar="BUF", type=int, default=1000,
                     help='Size of buffer of records. Will upload to database when buffer is full. '
-                         '(Useful if you notice a speed increase by buffering more or fewer records).')
+                         '(Useful if you notice a speed increase by buffering more or fewer records). '
+                         'Set to 0 to buffer the whole file. Buffers of any size are matched against '
+                         'the database in groups of %d records, and written in batches no larger than '
+                         'the server\'s maxWriteBatchSize.' % MATCH_QUERY_GROUP_SIZE)
 parser.add_argument('-s', '--sep', type=float, default=0.0,
                     help='Separation threshold under which objects are considered the same\n(units: arcseconds)')
 parser.add_argument('--src', help="Optionally override file source for inserted records", required=False)
@@ -421,13 +792,26 @@ parser.add_argument('--delim', type=allow_escape_chars, default=None,
 parser.add_argument('--coords', type=coords_type, default="RA, DEC",
                     help="Name of fields to use as coordinates.")
 
-args = parser.parse_args()
 
-if args.src is None:
-    args.src = args.source_path.split(os_path_sep)[-1]
 
-if args.format == "guess":
-    args.format = None
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments, filling in defaults that depend on other arguments
+    :param argv: Arguments to parse
+                 Default: sys.argv
+    :return: Parsed arguments
+    """
+    parsed_args = parser.parse_args(argv)
+
+    if parsed_args.src is None:
+        parsed_args.src = parsed_args.source_path.split(os_path_sep)[-1]
+
+    if parsed_args.format == "guess":
+        parsed_args.format = None
+
+    return parsed_args
+
 
 if __name__ == '__main__':
+    args = parse_args()
     main()
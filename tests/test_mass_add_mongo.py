@@ -0,0 +1,203 @@
+import argparse
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import mass_add_mongo as mam  # noqa: E402
+
+
+def make_record(ra: float, dec: float, data=None) -> dict:
+    """
+    Build a single-object record, as generate_records would
+    """
+    record = {
+        mam.DATA_KEY: [data if data is not None else {"ra": ra, "dec": dec}],
+        mam.COORDS_KEY: {"ra": {"min": ra, "max": ra, "med": ra},
+                         "dec": {"min": dec, "max": dec, "med": dec}}
+    }
+    mam.set_geo_point(record)
+    return record
+
+
+class FakeResult:
+    def __init__(self, inserted_count: int, matched_count: int):
+        self.inserted_count = inserted_count
+        self.matched_count = matched_count
+
+
+class FakeCollection:
+    """
+    Answers the queries insert_record_list makes from a list of stored records
+    """
+
+    def __init__(self, records: list):
+        self.records = records
+        self.writes = []
+
+    def find(self, query: dict, projection=None):
+        if "$or" in query:
+            for record in self.records:
+                for clause in query["$or"]:
+                    (lon, lat), radius = clause[mam.LOC_KEY]["$geoWithin"]["$centerSphere"]
+                    lon2, lat2 = record[mam.LOC_KEY]["coordinates"]
+                    if mam.separation_arcsec(lon, lat, lon2, lat2) <= np.degrees(radius) * 3600:
+                        yield {key: value for key, value in record.items() if key != mam.DATA_KEY}
+                        break
+        else:
+            ids = query["_id"]["$in"]
+            for record in self.records:
+                if record["_id"] in ids:
+                    yield {"_id": record["_id"], mam.DATA_KEY: record[mam.DATA_KEY]}
+
+    def bulk_write(self, operations: list, ordered: bool = True):
+        self.writes.append(operations)
+        return FakeResult(sum(isinstance(op, pymongo.InsertOne) for op in operations),
+                          sum(isinstance(op, pymongo.UpdateOne) for op in operations))
+
+
+class MergeCoordsTest(unittest.TestCase):
+
+    def test_bounds_cover_both_records(self):
+        coords1 = make_record(10.0, -5.0)[mam.COORDS_KEY]
+        coords2 = make_record(12.0, -7.0)[mam.COORDS_KEY]
+
+        merged = mam.merge_coords(coords1, coords2)
+
+        self.assertEqual(merged["ra"], {"min": 10.0, "max": 12.0, "med": 11.0})
+        self.assertEqual(merged["dec"], {"min": -7.0, "max": -5.0, "med": -6.0})
+
+    def test_merge_records_keeps_all_data(self):
+        mam.total_record_count = 2
+
+        merged = mam.merge_records(make_record(10.0, 0.0, "a"), make_record(10.0, 0.001, "b"))
+
+        self.assertEqual(merged[mam.DATA_KEY], ["a", "b"])
+        self.assertEqual(merged[mam.COORDS_KEY]["dec"]["max"], 0.001)
+        self.assertEqual(merged[mam.LOC_KEY]["coordinates"], [10.0, 0.0005])
+        self.assertEqual(mam.total_record_count, 1)
+
+
+class SeparationTest(unittest.TestCase):
+
+    def test_known_separations(self):
+        self.assertAlmostEqual(mam.separation_arcsec(10.0, 0.0, 10.0, 1.0), 3600.0, places=6)
+        self.assertAlmostEqual(mam.separation_arcsec(359.5, 0.0, 0.5, 0.0), 3600.0, places=6)
+        self.assertAlmostEqual(mam.separation_arcsec(0.0, 90.0, 180.0, 90.0), 0.0, places=6)
+        self.assertEqual(mam.separation_arcsec(1.0, 2.0, 1.0, 2.0), 0.0)
+
+
+class GeoPointTest(unittest.TestCase):
+
+    def test_ra_is_wrapped_into_longitude_range(self):
+        self.assertEqual(mam.geo_point(make_record(270.0, 10.0))["coordinates"], [-90.0, 10.0])
+        self.assertEqual(mam.geo_point(make_record(90.0, 10.0))["coordinates"], [90.0, 10.0])
+
+    def test_invalid_centers_have_no_point(self):
+        self.assertIsNone(mam.geo_point(make_record(10.0, 95.0)))
+        self.assertIsNone(mam.geo_point(make_record(float("nan"), 10.0)))
+        self.assertNotIn(mam.LOC_KEY, make_record(10.0, float("nan")))
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def random_records(self, rng: random.Random) -> list:
+        # Clusters of nearby objects, including around the RA wrap-around and the poles
+        centers = [(rng.uniform(0, 360), rng.uniform(-90, 90)) for _ in range(20)]
+        centers += [(359.9999, 0.0), (0.0001, 0.0), (0.0, 89.9999), (180.0, -89.9999)]
+        records = []
+        for ra, dec in centers:
+            records.append(make_record(ra, dec))
+            records.append(make_record(ra, dec))
+            for _ in range(5):
+                jitter_dec = min(90.0, max(-90.0, dec + rng.uniform(-5, 5) / 3600))
+                records.append(make_record((ra + rng.uniform(-5, 5) / 3600) % 360, jitter_dec))
+        return records
+
+    def test_index_matches_brute_force(self):
+        records = self.random_records(random.Random(0))
+        for threshold in (0.0, 1.0, 3.0, 30.0):
+            cell_size = mam.index_cell_size(threshold)
+            index = {}
+            for record in records:
+                mam.index_add(index, record, cell_size)
+
+            for record in records:
+                indexed = {id(existing_record) for _, existing_record
+                           in mam.indexed_matches(record, index, cell_size, threshold)}
+                brute_force = {id(existing_record) for existing_record in records
+                               if mam.should_merge_by_distance(record, existing_record, threshold)}
+                self.assertEqual(indexed, brute_force)
+
+    def test_append_record_skips_non_finite_centers(self):
+        mam.args = argparse.Namespace(sep=1.0)
+        mam.total_record_count = 3
+        buffer, index = {}, {}
+
+        for record in (make_record(10.0, 0.0), make_record(float("nan"), 0.0), make_record(10.0, 0.0)):
+            mam.append_record(record, buffer, index)
+
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(mam.total_record_count, 2)
+
+
+class InsertRecordListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group_size = mam.MATCH_QUERY_GROUP_SIZE
+        mam.MATCH_QUERY_GROUP_SIZE = 1
+
+    def tearDown(self):
+        mam.MATCH_QUERY_GROUP_SIZE = self.group_size
+
+    def stored_record(self, _id: int, ra: float, dec: float, data: str) -> dict:
+        record = make_record(ra, dec, data)
+        record["_id"] = _id
+        return record
+
+    def test_candidate_found_by_several_query_groups_is_matched_once(self):
+        collection = FakeCollection([self.stored_record(1, 10.0, 10.0, "E1"),
+                                     self.stored_record(2, 10.0, 10.0 + 1 / 3600, "E2")])
+        mam.total_record_count = 2
+
+        # Both new records are near both stored records, and each is queried in its own group
+        written_count = mam.insert_record_list([make_record(10.0, 10.0 + 0.5 / 3600, "A"),
+                                                make_record(10.0, 10.0 + 1.5 / 3600, "B")],
+                                               collection, 2.0)
+
+        operations, deletes = collection.writes
+        updates = [op for op in operations if isinstance(op, pymongo.UpdateOne)]
+        inserts = [op for op in operations if isinstance(op, pymongo.InsertOne)]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]._doc["$push"][mam.DATA_KEY]["$each"], ["A", "E2"])
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(deletes, [pymongo.DeleteOne({"_id": 2})])
+        self.assertEqual(written_count, 2)
+        self.assertEqual(mam.total_record_count, 0)
+
+    def test_records_without_position_are_inserted(self):
+        collection = FakeCollection([self.stored_record(1, 10.0, 10.0, "E1")])
+
+        mam.insert_record_list([make_record(10.0, 95.0, "A")], collection, 2.0)
+
+        self.assertEqual(len(collection.writes), 1)
+        self.assertIsInstance(collection.writes[0][0], pymongo.InsertOne)
+
+
+class ColumnValuesTest(unittest.TestCase):
+
+    def test_large_unsigned_values_are_strings(self):
+        column = np.array([0, 2 ** 63 - 1, 2 ** 63], dtype=np.uint64)
+        self.assertEqual(mam.column_values(column), [0, 2 ** 63 - 1, str(2 ** 63)])
+
+    def test_strings_are_stripped(self):
+        self.assertEqual(mam.column_values(np.array([b"a  ", b"bc"])), [b"a", b"bc"])
+
+
+if __name__ == '__main__':
+    unittest.main()